@@ -1,6 +1,10 @@
 import os
+import threading
+import time
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from fastapi import Request, Response
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -28,4 +32,158 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+# 5. 읽기 전용 복제본 (선택)
+# DB_REPLICA_URL이 없으면 모든 조회가 기본 DB로 갑니다.
+# 로컬에서는 Postgres를 두 개 띄우고 DB_REPLICA_URL=postgresql://user:pw@localhost:5433/db 처럼 지정하면 됩니다.
+# (복제 구성이 아닌 독립 인스턴스도 지연 0으로 간주하므로 라우팅 동작 확인 가능)
+SQLALCHEMY_REPLICA_URL = os.getenv("DB_REPLICA_URL")
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))        # 이보다 뒤처지면 기본 DB로 조회
+REPLICA_HEALTH_CHECK_SECONDS = float(os.getenv("DB_REPLICA_HEALTH_CHECK_SECONDS", "10"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))       # 수정 직후 기본 DB로 조회하는 시간
+
+replica_engine = None
+ReadSessionLocal = None
+if SQLALCHEMY_REPLICA_URL:
+    replica_engine = create_engine(
+        SQLALCHEMY_REPLICA_URL,
+        pool_pre_ping=True,
+        connect_args={"connect_timeout": 3}
+    )
+    ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+
+# 복제 지연(초). 기본 DB(복제본이 아닌 인스턴스)에서는 NULL이므로 0으로 처리
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+_replica_state = {"healthy": False, "checked_at": 0.0}
+_replica_lock = threading.Lock()
+
+# read-your-writes 표시
+# Cloud Run은 요청마다 다른 인스턴스로 갈 수 있으므로, 마지막 수정 시각(epoch 초)을
+# 쿠키와 응답 헤더로 클라이언트에 보내고 조회 요청에서 다시 확인합니다.
+# (쿠키를 쓸 수 없는 클라이언트는 받은 X-Last-Write-At 값을 같은 헤더로 다시 보내면 됨)
+LAST_WRITE_COOKIE = "last_write_at"
+LAST_WRITE_HEADER = "X-Last-Write-At"
+
+# 최근 수정된 대상 -> 기본 DB로 조회해야 하는 만료 시각 (같은 인스턴스로 온 요청용 보조 수단)
+_recent_writes = {}
+_recent_writes_lock = threading.Lock()
+
+
+def replica_is_healthy():
+    """
+    복제본 상태를 주기적으로 확인합니다. 접속 실패나 지연 초과 시 False.
+    확인은 한 요청만 하고, 그동안 다른 요청은 기다리지 않고 마지막 결과를 사용합니다.
+    """
+    if replica_engine is None:
+        return False
+
+    if time.monotonic() - _replica_state["checked_at"] < REPLICA_HEALTH_CHECK_SECONDS:
+        return _replica_state["healthy"]
+    if not _replica_lock.acquire(blocking=False):
+        return _replica_state["healthy"]
+
+    try:
+        try:
+            with replica_engine.connect() as conn:
+                lag = conn.execute(REPLICA_LAG_SQL).scalar()
+            healthy = (lag or 0) <= REPLICA_MAX_LAG_SECONDS
+            if not healthy:
+                print(f"복제본 지연 {lag:.1f}s, 기본 DB로 조회합니다.")
+        except Exception as e:
+            print(f"복제본 상태 확인 실패, 기본 DB로 조회합니다: {e}")
+            healthy = False
+
+        _replica_state["healthy"] = healthy
+        _replica_state["checked_at"] = time.monotonic()
+        return healthy
+    finally:
+        _replica_lock.release()
+
+
+def _mark_replica_unhealthy(error):
+    """조회 중 복제본 오류가 나면 다음 상태 확인 전까지 기본 DB를 사용합니다."""
+    print(f"복제본 조회 실패, 기본 DB로 전환합니다: {error}")
+    _replica_state["healthy"] = False
+    _replica_state["checked_at"] = time.monotonic()
+
+
+def mark_written(response: Response, user_id=None, diary_id=None):
+    """수정 직후 잠시 동안 해당 사용자/일기 조회를 기본 DB로 보냅니다 (read-your-writes)."""
+    written_at = f"{time.time():.3f}"
+    response.headers[LAST_WRITE_HEADER] = written_at
+    response.set_cookie(
+        LAST_WRITE_COOKIE, written_at,
+        max_age=int(READ_YOUR_WRITES_SECONDS) + 1,
+        httponly=True, secure=True, samesite="none"  # 프론트엔드가 다른 도메인이므로 SameSite=None
+    )
+
+    expires_at = time.monotonic() + READ_YOUR_WRITES_SECONDS
+    with _recent_writes_lock:
+        if user_id is not None:
+            _recent_writes[("user", str(user_id))] = expires_at
+        if diary_id is not None:
+            _recent_writes[("diary", str(diary_id))] = expires_at
+
+
+def _recently_written(keys):
+    now = time.monotonic()
+    with _recent_writes_lock:
+        # 만료된 항목 정리
+        for key in [k for k, expires_at in _recent_writes.items() if expires_at < now]:
+            del _recent_writes[key]
+        return any(key in _recent_writes for key in keys)
+
+
+def _client_wrote_recently(request: Request):
+    """클라이언트가 보낸 마지막 수정 시각(쿠키 또는 헤더)이 read-your-writes 시간 안인지 확인합니다."""
+    value = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        return value is not None and time.time() - float(value) < READ_YOUR_WRITES_SECONDS
+    except ValueError:
+        return False
+
+
+def get_read_db(request: Request):
+    """
+    조회 전용 세션. 복제본이 설정되어 있고 정상이면 복제본을 사용합니다.
+    클라이언트가 방금 수정했거나(쿠키/헤더), 요청의 user_id / diary_id가
+    이 인스턴스에서 최근 수정된 대상이면 기본 DB를 사용합니다.
+    """
+    keys = []
+    user_id = request.query_params.get("user_id") or request.path_params.get("user_id")
+    diary_id = request.path_params.get("diary_id")
+    if user_id is not None:
+        keys.append(("user", str(user_id)))
+    if diary_id is not None:
+        keys.append(("diary", str(diary_id)))
+
+    db = None
+    if not (_client_wrote_recently(request) or _recently_written(keys)) and replica_is_healthy():
+        db = ReadSessionLocal()
+        try:
+            # 복제본 연결을 미리 열어 보고, 실패하면 이 요청은 기본 DB로 조회
+            db.connection()
+        except OperationalError as e:
+            db.close()
+            db = None
+            _mark_replica_unhealthy(e)
+    if db is None:
+        db = SessionLocal()
+
+    try:
+        yield db
+    except OperationalError as e:
+        # 조회 도중 복제본이 끊긴 경우, 이후 요청은 기본 DB로 보냄
+        if db.get_bind() is replica_engine:
+            _mark_replica_unhealthy(e)
+        raise
+    finally:
+        db.close()
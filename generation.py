@@ -0,0 +1,295 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+import google.generativeai as genai
+import vertexai
+from vertexai.preview.vision_models import ImageGenerationModel
+
+from google.cloud import storage
+
+from prompts import SYSTEM_PROMPT_TEMPLATE, USER_PROMPT_TEMPLATE, IMAGE_PROMPT_TEMPLATE
+from image_index import prompt_image_index
+
+load_dotenv()
+
+# Google AI 모델 (API 서버가 아니라 worker.py에서 호출됨)
+
+# Gemini API
+genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+gemini_model = genai.GenerativeModel(
+    model_name="gemini-2.5-pro",
+    generation_config={"response_mime_type": "application/json"}
+)
+
+# Imagen
+project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
+location = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+vertexai.init(project=project_id, location=location)
+imagen_model = ImageGenerationModel.from_pretrained("imagegeneration@006")
+
+storage_client = storage.Client()
+
+# 유사 프롬프트 재사용용 임베딩 모델
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")
+
+# 호출 시간 제한 설정
+EMBEDDING_TIMEOUT_SECONDS = float(os.getenv("EMBEDDING_TIMEOUT_SECONDS", "10"))     # 임베딩 호출 1회 제한 시간
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "90"))           # Gemini 호출 1회 제한 시간
+IMAGEN_CALL_TIMEOUT_SECONDS = float(os.getenv("IMAGEN_CALL_TIMEOUT_SECONDS", "60")) # Imagen 호출 1회 제한 시간
+DIARY_BUDGET_SECONDS = float(os.getenv("DIARY_BUDGET_SECONDS", "150"))              # 일기 1건 전체 생성 예산 (Gemini + 모든 컷)
+IMAGEN_MAX_CONCURRENCY = int(os.getenv("IMAGEN_MAX_CONCURRENCY", "8"))              # 워커 1개가 동시에 보내는 Imagen 호출 수
+
+# 헤지 요청: 컷이 최근 p95 지연을 넘기면 같은 요청을 하나 더 보내고 먼저 끝난 결과를 사용
+IMAGEN_HEDGE_ENABLED = os.getenv("IMAGEN_HEDGE_ENABLED", "false").lower() == "true"
+IMAGEN_HEDGE_PERCENTILE = float(os.getenv("IMAGEN_HEDGE_PERCENTILE", "95"))
+IMAGEN_HEDGE_MIN_SAMPLES = int(os.getenv("IMAGEN_HEDGE_MIN_SAMPLES", "20"))         # 지연 표본이 이보다 적으면 헤지하지 않음
+IMAGEN_HEDGE_MAX_CONCURRENCY = int(os.getenv("IMAGEN_HEDGE_MAX_CONCURRENCY", "4"))  # 헤지 요청 전용 스레드 수
+
+# Imagen 호출 전용 스레드 풀 (시간 초과된 호출은 결과를 버리고 백그라운드에서 끝나게 둠)
+# generate_images에는 자체 제한 시간이 없어 포기한 호출도 스레드를 계속 점유하므로,
+# 헤지 요청은 별도 풀에서 보내 첫 요청들 뒤에 줄 서지 않게 합니다.
+_imagen_executor = ThreadPoolExecutor(max_workers=IMAGEN_MAX_CONCURRENCY, thread_name_prefix="imagen")
+_imagen_hedge_executor = ThreadPoolExecutor(max_workers=IMAGEN_HEDGE_MAX_CONCURRENCY, thread_name_prefix="imagen-hedge")
+IMAGEN_QUEUE_POLL_SECONDS = 0.1  # 호출이 풀에서 실행을 기다리는 동안 시작 여부를 확인하는 간격
+
+# 결과를 포기했지만 아직 스레드를 점유하고 있는 호출 수
+_abandoned_calls = 0
+_abandoned_lock = threading.Lock()
+
+
+class LatencyTracker:
+    """최근 호출 지연 시간을 모아 백분위수를 계산합니다."""
+
+    def __init__(self, maxlen=200):
+        self._samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct, min_samples=1):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * pct / 100))
+        return samples[index]
+
+
+imagen_latency = LatencyTracker()
+
+# 이미지 생성 실패 시 사용하는 임시 URL
+PLACEHOLDER_URL = "https://via.placeholder.com/1024?text=Generation+Failed"
+REGEN_PLACEHOLDER_URL = "https://via.placeholder.com/1024?text=Regeneration+Failed"
+
+def upload_to_gcs(source_file_name, destination_blob_name):
+    """로컬 파일을 GCS에 올리고 공개 URL을 반환합니다."""
+
+    # 함수 내에서 BUCKET_NAME을 직접 읽고, 없으면 오류 처리
+    bucket_name = os.getenv("GCS_BUCKET_NAME")
+
+    # 만약 환경 변수가 없으면 오류 발생
+    if not bucket_name:
+        raise Exception("GCS_BUCKET_NAME 환경 변수가 설정되지 않았거나 로드 실패.")
+
+    try:
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.blob(destination_blob_name)
+
+        # 파일 업로드
+        blob.upload_from_filename(source_file_name)
+
+        # 공개 URL 반환
+        return f"https://storage.googleapis.com/{bucket_name}/{destination_blob_name}"
+    except Exception as e:
+        print(f"GCS Upload Error: {e}")
+        # 오류가 나더라도 다음 처리를 위해 예외를 다시 발생시킵니다.
+        raise e
+
+def remaining_seconds(deadline, limit):
+    """호출 1회 제한(limit)과 전체 마감(deadline, time.monotonic 기준) 중 짧은 쪽을 반환합니다."""
+    if deadline is None:
+        return limit
+    remaining = min(limit, deadline - time.monotonic())
+    if remaining <= 0:
+        raise TimeoutError("요청 예산을 모두 사용했습니다.")
+    return remaining
+
+def generate_story(original_content, genre, style, character_note, cuts_count, deadline=None):
+    """Gemini로 일기를 각색하고 {"full_story", "cuts"} 딕셔너리를 반환합니다."""
+    formatted_user_prompt = USER_PROMPT_TEMPLATE.format(
+        original_content=original_content,
+        genre=genre,
+        style=style,
+        character=character_note,
+        cuts=cuts_count
+    )
+
+    response = gemini_model.generate_content(
+        f"{SYSTEM_PROMPT_TEMPLATE.format(cuts=cuts_count)}\n{formatted_user_prompt}",
+        request_options={"timeout": remaining_seconds(deadline, GEMINI_TIMEOUT_SECONDS)}
+    )
+    return json.loads(response.text)
+
+def build_image_prompt(style, character_note, action_description, background_description):
+    """Imagen에 보낼 최종 프롬프트를 조립합니다."""
+    return IMAGE_PROMPT_TEMPLATE.format(
+        style=style,
+        character=character_note,
+        action_description=action_description,
+        background_description=background_description # Gemini가 준 프롬프트
+    )
+
+def _request_image(prompt):
+    """Imagen 호출 1회. 성공한 호출의 지연 시간을 기록합니다."""
+    started = time.monotonic()
+    response = imagen_model.generate_images(
+        prompt=prompt,
+        number_of_images=1,
+        aspect_ratio="1:1",
+        safety_filter_level="block_some",
+        person_generation="allow_adult"
+    )
+
+    if not response or not response.images:
+        raise ValueError("Imagen이 이미지를 반환하지 않았습니다. (안전 필터 차단)")
+
+    imagen_latency.record(time.monotonic() - started)
+    return response
+
+def _submit_image_request(executor, prompt):
+    """Imagen 호출을 풀에 넣습니다. 실제 실행이 시작된 시각이 담길 리스트를 함께 반환합니다."""
+    started = []
+
+    def run():
+        started.append(time.monotonic())
+        return _request_image(prompt)
+
+    return executor.submit(run), started
+
+def _release_abandoned(future):
+    global _abandoned_calls
+    with _abandoned_lock:
+        _abandoned_calls -= 1
+
+def _abandon(futures):
+    """결과를 더 기다리지 않을 호출을 정리합니다. 아직 시작 전이면 취소하고, 실행 중이면 백그라운드에서 끝나게 둡니다."""
+    global _abandoned_calls
+    running = [future for future in futures if not future.cancel()]
+    if not running:
+        return
+    with _abandoned_lock:
+        _abandoned_calls += len(running)
+        total = _abandoned_calls
+    for future in running:
+        future.add_done_callback(_release_abandoned)
+    print(f"   - Imagen 호출 {len(running)}개 포기 (응답 없이 스레드를 점유 중인 호출 {total}개)")
+
+def _request_image_with_deadline(prompt, timeout, deadline=None):
+    """
+    제한 시간 안에 Imagen 결과를 받아옵니다. 필요하면 헤지 요청을 보내고 먼저 성공한 결과를 사용합니다.
+    제한 시간(timeout)과 헤지 시점은 풀에서 기다린 시간을 빼고 호출이 실제로 시작된 시각부터 잽니다.
+    풀에서 기다리는 시간은 따로 timeout까지만 허용하며, 전체 마감(deadline)은 항상 지킵니다.
+    """
+    submitted = time.monotonic()
+    future, started = _submit_image_request(_imagen_executor, prompt)
+    futures = [future]
+
+    hedge_after = None
+    if IMAGEN_HEDGE_ENABLED:
+        hedge_after = imagen_latency.percentile(IMAGEN_HEDGE_PERCENTILE, IMAGEN_HEDGE_MIN_SAMPLES)
+
+    last_error = None
+    while futures:
+        now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            break
+        if now - (started[0] if started else submitted) >= timeout:
+            break
+
+        if started:
+            elapsed = now - started[0]
+            wait_for = timeout - elapsed
+            if hedge_after is not None:
+                wait_for = min(wait_for, max(hedge_after - elapsed, 0))
+        else:
+            # 아직 풀에서 대기 중 (다른 호출이 스레드를 모두 점유)
+            wait_for = min(IMAGEN_QUEUE_POLL_SECONDS, timeout - (now - submitted))
+        if deadline is not None:
+            wait_for = min(wait_for, deadline - now)
+
+        done, _ = wait(futures, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for future in done:
+            futures.remove(future)
+            try:
+                return future.result()
+            except Exception as e:
+                last_error = e
+
+        if hedge_after is not None and not done and started and time.monotonic() - started[0] >= hedge_after:
+            print(f"   - Imagen 응답 지연 ({hedge_after:.1f}s 초과), 헤지 요청 전송")
+            futures.append(_submit_image_request(_imagen_hedge_executor, prompt)[0])
+            hedge_after = None
+
+    if futures:
+        _abandon(futures)
+    elif last_error is not None:
+        raise last_error
+    raise TimeoutError(f"Imagen 응답 시간 초과 ({timeout:.1f}s)")
+
+def generate_image(prompt, filename, deadline=None):
+    """
+    Imagen으로 이미지를 만들고 GCS에 올린 뒤 공개 URL을 반환합니다.
+    호출 1회 제한 시간과 전체 마감(deadline) 중 짧은 쪽을 넘기면 TimeoutError가 발생합니다.
+    """
+    response = _request_image_with_deadline(prompt, remaining_seconds(deadline, IMAGEN_CALL_TIMEOUT_SECONDS), deadline)
+
+    temp_path = f"temp_{filename}"
+    try:
+        response.images[0].save(location=temp_path, include_generation_parameters=False)
+        return upload_to_gcs(temp_path, filename)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def make_filename(story_id, cut_number, suffix=""):
+    """GCS에 저장할 고유 파일명을 만듭니다."""
+    return f"{story_id}_{cut_number}_{uuid.uuid4().hex[:8]}{suffix}.png"
+
+def embed_prompt(prompt, deadline=None):
+    """이미지 프롬프트의 임베딩 벡터를 반환합니다."""
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=prompt,
+        task_type="semantic_similarity",
+        request_options={"timeout": remaining_seconds(deadline, EMBEDDING_TIMEOUT_SECONDS)}
+    )
+    return result["embedding"]
+
+def generate_or_reuse_image(prompt, style, filename, deadline=None):
+    """
+    같은 스타일의 아주 비슷한 프롬프트로 만든 이미지가 있으면 재사용하고, 없으면 새로 생성합니다.
+    (이미지 URL, 프롬프트 임베딩)을 반환하며, 임베딩 저장은 DB 세션을 가진 호출한 쪽에서 합니다.
+    IMAGE_INDEX_ENABLED가 꺼져 있거나 임베딩 호출이 실패하면 임베딩은 None입니다.
+    """
+    if prompt_image_index is None:
+        return generate_image(prompt, filename, deadline), None
+
+    embedding = None
+    try:
+        embedding = embed_prompt(prompt, deadline)
+        reused_url = prompt_image_index.lookup(embedding, style)
+        if reused_url:
+            print(f"   -> 유사 프롬프트 이미지 재사용: {reused_url}")
+            return reused_url, embedding
+    except Exception as e:
+        print(f"   - 프롬프트 임베딩 실패, 새로 생성합니다: {e}")
+
+    return generate_image(prompt, filename, deadline), embedding
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+import models
+
+# Idempotency-Key 설정
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))          # 저장된 응답 보관 시간
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))  # 처리 중인 같은 요청을 기다리는 최대 시간
+IDEMPOTENCY_STALE_SECONDS = int(os.getenv("IDEMPOTENCY_STALE_SECONDS", "60"))  # in_progress가 이보다 오래되면 처리 중 서버가 죽은 것으로 간주
+
+# 같은 인스턴스 안에서 처리 중인 키 (single-flight: 재시도는 DB 폴링 없이 완료 신호를 기다림)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def request_hash(body):
+    """요청 본문 해시 (같은 키로 다른 요청을 보내는 실수 감지용)"""
+    raw = json.dumps(body, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _claim(db: Session, scope, key, body_hash):
+    """키를 선점하면 True, 이미 누군가 등록했으면 False를 반환합니다."""
+    # 만료된 기록과 처리 중 죽은 기록은 지우고 다시 선점할 수 있게 함
+    db.query(models.IdempotencyRecord).\
+        filter(models.IdempotencyRecord.scope == scope,
+               models.IdempotencyRecord.idempotency_key == key).\
+        filter(
+            (models.IdempotencyRecord.created_at < func.now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)) |
+            ((models.IdempotencyRecord.status == "in_progress") &
+             (models.IdempotencyRecord.updated_at < func.now() - timedelta(seconds=IDEMPOTENCY_STALE_SECONDS)))
+        ).\
+        delete(synchronize_session=False)
+
+    stmt = insert(models.IdempotencyRecord).values(
+        scope=scope,
+        idempotency_key=key,
+        request_hash=body_hash,
+        status="in_progress"
+    ).on_conflict_do_nothing(constraint="uq_idempotency_scope_key")
+    inserted = db.execute(stmt).rowcount
+    db.commit()
+    return inserted == 1
+
+
+def purge_expired_records(db: Session):
+    """보관 시간이 지난 기록을 지웁니다 (요청마다 새 키를 쓰므로 주기적으로 정리). 지운 개수를 반환합니다."""
+    deleted = db.query(models.IdempotencyRecord).\
+        filter(models.IdempotencyRecord.created_at < func.now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)).\
+        delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+
+def _load(db: Session, scope, key):
+    db.expire_all()
+    return db.query(models.IdempotencyRecord).\
+        filter(models.IdempotencyRecord.scope == scope,
+               models.IdempotencyRecord.idempotency_key == key).\
+        first()
+
+
+def _wait_for_completion(db: Session, scope, key):
+    """
+    다른 요청이 처리 중인 같은 키의 응답을 기다립니다.
+    완료된 기록을 반환하고, 처리하던 요청이 실패해 기록이 지워졌으면 None, 시간 내에 끝나지 않으면 False를 반환합니다.
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        with _inflight_lock:
+            event = _inflight.get((scope, key))
+        remaining = deadline - time.monotonic()
+        if event is not None:
+            # 같은 인스턴스에서 처리 중이면 완료 신호를 기다림
+            event.wait(max(remaining, 0))
+        else:
+            # 다른 인스턴스에서 처리 중이면 DB를 짧게 폴링
+            time.sleep(min(0.2, max(remaining, 0)))
+
+        record = _load(db, scope, key)
+        if record is None or record.status == "completed":
+            return record
+        if time.monotonic() >= deadline:
+            return False
+
+
+def run_idempotent(db: Session, scope, key, body, handler):
+    """
+    Idempotency-Key가 있으면 첫 요청만 handler를 실행하고 응답을 저장합니다.
+    같은 키로 들어온 재시도는 저장된 응답을 받거나, 처리 중인 요청에 합류해 같은 응답을 받습니다.
+    """
+    if not key:
+        return handler()
+
+    body_hash = request_hash(body)
+
+    # 키를 선점하지 못하면 먼저 온 요청의 응답을 기다림
+    # 먼저 온 요청이 실패해 기록이 지워지면 다시 선점을 시도해 이 요청이 직접 처리
+    while not _claim(db, scope, key, body_hash):
+        record = _load(db, scope, key)
+        if record is None:
+            continue
+        if record.request_hash != body_hash:
+            raise HTTPException(status_code=422, detail="같은 Idempotency-Key로 다른 요청을 보낼 수 없습니다.")
+
+        if record.status != "completed":
+            record = _wait_for_completion(db, scope, key)
+            if record is None:
+                continue
+            if record is False:
+                raise HTTPException(status_code=409, detail="같은 요청을 처리 중입니다. 잠시 후 다시 시도해주세요.")
+
+        return record.response_body
+
+    event = threading.Event()
+    with _inflight_lock:
+        _inflight[(scope, key)] = event
+    try:
+        response = handler()
+
+        # 응답을 먼저 저장한 뒤 기다리는 요청을 깨워야 저장된 응답을 바로 받을 수 있음
+        record = _load(db, scope, key)
+        if record is not None:
+            record.status = "completed"
+            record.response_body = response
+            db.commit()
+        return response
+    except Exception:
+        # 실패한 요청은 저장하지 않음 (같은 키로 다시 시도 가능)
+        db.rollback()
+        db.query(models.IdempotencyRecord).\
+            filter(models.IdempotencyRecord.scope == scope,
+                   models.IdempotencyRecord.idempotency_key == key).\
+            delete(synchronize_session=False)
+        db.commit()
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop((scope, key), None)
+        event.set()
@@ -0,0 +1,273 @@
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+import models
+
+# 유사 프롬프트 이미지 재사용 설정 (기본 비활성)
+# 임베딩 원본은 prompt_embeddings 테이블에 저장되므로 재시작 후에도 유지되고 모든 워커가 공유합니다.
+# 각 워커는 이 테이블을 주기적으로 읽어 메모리의 NumPy 행렬을 맞춥니다.
+IMAGE_INDEX_ENABLED = os.getenv("IMAGE_INDEX_ENABLED", "false").lower() == "true"
+IMAGE_INDEX_MAX_SIZE = int(os.getenv("IMAGE_INDEX_MAX_SIZE", "5000"))                 # 메모리에 올리는 최대 개수 (초과 시 가장 오래 안 쓰인 항목 교체)
+IMAGE_INDEX_BACKFILL_BATCH = int(os.getenv("IMAGE_INDEX_BACKFILL_BATCH", "50"))       # 동기화 1회에 임베딩할 기존 완료 컷 수
+IMAGE_INDEX_DEFAULT_THRESHOLD = float(os.getenv("IMAGE_INDEX_DEFAULT_THRESHOLD", "0.95"))
+IMAGE_INDEX_STYLE_THRESHOLDS = json.loads(os.getenv("IMAGE_INDEX_STYLE_THRESHOLDS", "{}"))  # 예: {"지브리": 0.93}
+
+# 다른 워커가 늦게 커밋한 행도 놓치지 않도록 동기화 시 겹쳐 읽는 시간
+SYNC_OVERLAP = timedelta(minutes=5)
+
+# 백필은 워커 하나만 하도록 잠그는 pg_try_advisory_xact_lock namespace (jobs.py / scheduler.py의 LOCK_NS_*와 겹치지 않게)
+LOCK_NS_INDEX_BACKFILL = 4
+
+# 생성 실패 시 저장되는 임시 이미지 (generation.PLACEHOLDER_URL 등). 재사용 대상이 아님
+# (예전 코드는 임시 이미지로 실패한 컷도 completed로 저장했으므로 URL로 걸러냄)
+PLACEHOLDER_URL_PREFIX = "https://via.placeholder.com/"
+
+
+def is_placeholder_url(url):
+    return not url or url.startswith(PLACEHOLDER_URL_PREFIX)
+
+
+def normalize_embedding(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def embedding_to_bytes(embedding):
+    return normalize_embedding(embedding).tobytes()
+
+
+def bytes_to_embedding(data):
+    return np.frombuffer(data, dtype=np.float32)
+
+
+class PromptImageIndex:
+    """
+    이미지 프롬프트 임베딩 -> 생성된 이미지 URL 인덱스 (컷 ID 단위).
+    임베딩은 정규화된 float32 행렬 하나에 모아 두고, 행렬 곱 한 번으로 코사인 유사도를 계산합니다.
+    같은 작화 스타일 안에서만 비교하며, 스타일별 임계값 이상이면 기존 이미지를 재사용합니다.
+    """
+
+    def __init__(self, max_size, default_threshold=0.95, style_thresholds=None):
+        self.max_size = max_size
+        self.default_threshold = default_threshold
+        self.style_thresholds = style_thresholds or {}
+
+        self._lock = threading.Lock()
+        self._vectors = None                                    # (max_size, dim) float32, 첫 추가 시 할당
+        self._style_codes = np.full(max_size, -1, dtype=np.int32)
+        self._last_used = np.zeros(max_size, dtype=np.float64)
+        self._cut_ids = np.zeros(max_size, dtype=np.int64)
+        self._urls = [None] * max_size
+        self._slot_by_cut = {}                                  # 컷 ID -> 행 번호
+        self._styles = {}                                       # 스타일 이름 -> 코드
+        self._size = 0
+        self._synced_until = None                               # 마지막으로 불러온 행의 created_at
+        self._stats = {"lookups": 0, "hits": 0, "added": 0, "evicted": 0, "removed": 0}
+
+    def threshold_for(self, style):
+        return float(self.style_thresholds.get(style, self.default_threshold))
+
+    def lookup(self, embedding, style):
+        """임계값 이상으로 비슷한 프롬프트의 이미지 URL을 반환합니다. 없으면 None."""
+        query = normalize_embedding(embedding)
+        with self._lock:
+            self._stats["lookups"] += 1
+            code = self._styles.get(style)
+            if code is None or self._size == 0 or self._vectors.shape[1] != query.shape[0]:
+                return None
+
+            similarities = self._vectors[:self._size] @ query
+            similarities[self._style_codes[:self._size] != code] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold_for(style):
+                return None
+
+            if is_placeholder_url(self._urls[best]):
+                return None
+
+            self._last_used[best] = time.time()
+            self._stats["hits"] += 1
+            return self._urls[best]
+
+    def add(self, cut_id, embedding, style, url):
+        """컷의 이미지를 등록합니다. 같은 컷이 있으면 교체하고, 가득 차면 가장 오래 사용되지 않은 항목을 교체합니다."""
+        if is_placeholder_url(url):
+            return
+        vector = normalize_embedding(embedding)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+            elif self._vectors.shape[1] != vector.shape[0]:
+                # 임베딩 모델이 바뀐 경우 기존 항목과 비교할 수 없으므로 무시
+                return
+
+            slot = self._slot_by_cut.get(cut_id)
+            if slot is None:
+                if self._size < self.max_size:
+                    slot = self._size
+                    self._size += 1
+                else:
+                    slot = int(np.argmin(self._last_used[:self._size]))
+                    del self._slot_by_cut[int(self._cut_ids[slot])]
+                    self._stats["evicted"] += 1
+                self._slot_by_cut[cut_id] = slot
+
+            self._vectors[slot] = vector
+            self._style_codes[slot] = self._styles.setdefault(style, len(self._styles))
+            self._last_used[slot] = time.time()
+            self._cut_ids[slot] = cut_id
+            self._urls[slot] = url
+            self._stats["added"] += 1
+
+    def _remove_slot(self, slot):
+        """행을 지우고 마지막 행을 그 자리로 옮깁니다. (잠금을 잡은 상태에서 호출)"""
+        del self._slot_by_cut[int(self._cut_ids[slot])]
+        last = self._size - 1
+        if slot != last:
+            self._vectors[slot] = self._vectors[last]
+            self._style_codes[slot] = self._style_codes[last]
+            self._last_used[slot] = self._last_used[last]
+            self._cut_ids[slot] = self._cut_ids[last]
+            self._urls[slot] = self._urls[last]
+            self._slot_by_cut[int(self._cut_ids[slot])] = slot
+        self._urls[last] = None
+        self._size = last
+        self._stats["removed"] += 1
+
+    def remove_cuts(self, cut_ids):
+        with self._lock:
+            for cut_id in cut_ids:
+                slot = self._slot_by_cut.get(cut_id)
+                if slot is not None:
+                    self._remove_slot(slot)
+
+    def remove_urls(self, urls):
+        """해당 이미지를 쓰는 모든 항목을 지웁니다 (사용자가 재생성으로 거절한 이미지)."""
+        urls = set(urls)
+        with self._lock:
+            for slot in reversed(range(self._size)):
+                if self._urls[slot] in urls:
+                    self._remove_slot(slot)
+
+    def sync(self, db: Session):
+        """
+        prompt_embeddings 테이블과 맞춥니다.
+        새로 추가된 행은 불러오고, 컷 재생성/일기 삭제로 사라진 행은 메모리에서도 지웁니다.
+        """
+        query = db.query(models.PromptEmbedding).filter(models.PromptEmbedding.rejected.is_(False))
+        if self._synced_until is not None:
+            query = query.filter(models.PromptEmbedding.created_at > self._synced_until - SYNC_OVERLAP)
+        rows = query.order_by(models.PromptEmbedding.created_at.desc()).limit(self.max_size).all()
+        for row in reversed(rows):
+            # 새 컷이거나, 컷 재생성으로 이미지가 바뀐 경우
+            if self._url_of(row.cut_id) != row.image_url:
+                self.add(row.cut_id, bytes_to_embedding(row.embedding), row.style, row.image_url)
+        if rows:
+            self._synced_until = max(rows[0].created_at, self._synced_until or rows[0].created_at)
+
+        with self._lock:
+            known = list(self._slot_by_cut)
+        existing = set()
+        for start in range(0, len(known), 1000):
+            chunk = known[start:start + 1000]
+            existing.update(cut_id for (cut_id,) in
+                            db.query(models.PromptEmbedding.cut_id).
+                            filter(models.PromptEmbedding.cut_id.in_(chunk),
+                                   models.PromptEmbedding.rejected.is_(False)).all())
+        self.remove_cuts([cut_id for cut_id in known if cut_id not in existing])
+
+    def _url_of(self, cut_id):
+        with self._lock:
+            slot = self._slot_by_cut.get(cut_id)
+            return self._urls[slot] if slot is not None else None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+        # 인덱스 적중 1회 = Imagen 호출 1회 절약
+        stats["imagen_calls_avoided"] = stats["hits"]
+        stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+
+def save_prompt_embedding(db: Session, cut_id, style, image_url, embedding, replace=False):
+    """
+    컷의 임베딩을 테이블에 저장하고 이 워커의 인덱스에도 바로 등록합니다. 커밋은 호출한 쪽에서 합니다.
+    replace=True이면 컷 재생성으로 바뀐 이미지로 기존 행(거절 표시 포함)을 덮어씁니다.
+    """
+    if is_placeholder_url(image_url):
+        return
+    stmt = insert(models.PromptEmbedding).values(
+        cut_id=cut_id,
+        style=style,
+        image_url=image_url,
+        embedding=embedding_to_bytes(embedding),
+        rejected=False
+    )
+    if replace:
+        # created_at도 갱신해야 다른 워커의 sync가 바뀐 행을 다시 읽음
+        stmt = stmt.on_conflict_do_update(index_elements=["cut_id"], set_={
+            "style": stmt.excluded.style,
+            "image_url": stmt.excluded.image_url,
+            "embedding": stmt.excluded.embedding,
+            "rejected": False,
+            "created_at": func.now()
+        })
+    else:
+        # 다른 워커가 같은 컷을 먼저 저장했으면 그대로 둠 (커밋 시 충돌로 다른 행까지 잃지 않도록)
+        stmt = stmt.on_conflict_do_nothing(index_elements=["cut_id"])
+    db.execute(stmt)
+    if prompt_image_index is not None:
+        prompt_image_index.add(cut_id, embedding, style, image_url)
+
+
+def reject_images(db: Session, image_urls):
+    """
+    사용자가 재생성으로 거절한 이미지를 다시 재사용하지 않도록 표시하고 인덱스에서 지웁니다.
+    같은 이미지를 재사용 중인 다른 컷의 항목도 함께 제외됩니다. 커밋은 호출한 쪽에서 합니다.
+    """
+    image_urls = [url for url in image_urls if url]
+    if not image_urls:
+        return
+    db.query(models.PromptEmbedding).\
+        filter(models.PromptEmbedding.image_url.in_(image_urls)).\
+        update({models.PromptEmbedding.rejected: True}, synchronize_session=False)
+    if prompt_image_index is not None:
+        prompt_image_index.remove_urls(image_urls)
+
+
+def try_lock_backfill(db: Session):
+    """이번 트랜잭션 동안 백필을 맡습니다. 다른 워커가 백필 중이면 False (같은 컷을 중복으로 임베딩하지 않도록)"""
+    return db.execute(text("SELECT pg_try_advisory_xact_lock(:ns, 0)"), {"ns": LOCK_NS_INDEX_BACKFILL}).scalar()
+
+
+def cuts_missing_embeddings(db: Session, limit):
+    """임베딩 행이 아직 없는 완료된 컷 (최근 순). 인덱스 백필용 (거절 표시된 컷은 행이 있으므로 제외됨)"""
+    return db.query(models.Cut, models.Story.style).\
+        join(models.Story, models.Story.story_id == models.Cut.story_id).\
+        outerjoin(models.PromptEmbedding, models.PromptEmbedding.cut_id == models.Cut.cut_id).\
+        filter(models.Cut.status == "completed",
+               models.Cut.image_prompt.isnot(None),
+               ~models.Cut.image_url.startswith(PLACEHOLDER_URL_PREFIX),
+               models.PromptEmbedding.cut_id.is_(None)).\
+        order_by(models.Cut.created_at.desc()).\
+        limit(limit).all()
+
+
+prompt_image_index = None
+if IMAGE_INDEX_ENABLED:
+    prompt_image_index = PromptImageIndex(
+        IMAGE_INDEX_MAX_SIZE,
+        IMAGE_INDEX_DEFAULT_THRESHOLD,
+        IMAGE_INDEX_STYLE_THRESHOLDS
+    )
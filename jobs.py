@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+from datetime import timedelta
+from sqlalchemy import or_, and_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+import models
+from scheduler import (
+    JOB_PRIORITIES, RECOVERY_PRIORITY, USER_MAX_RUNNING_JOBS, job_cost, fair_tag, busy_users_query
+)
+
+# 작업 큐 설정
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "180"))        # 워커가 작업을 붙잡고 있을 수 있는 시간 (하트비트로 연장)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))            # 리스 만료로 회수된 작업의 최대 재시도 횟수
+STUCK_CUT_SECONDS = int(os.getenv("STUCK_CUT_SECONDS", "900"))        # 담당 작업 없이 pending 상태로 남은 컷 회수 기준
+
+CLAIM_BATCH_SIZE = int(os.getenv("JOB_CLAIM_BATCH_SIZE", "20"))      # 한 번에 잠가 보고 고르는 후보 작업 수
+
+ACTIVE_STATUSES = ("queued", "running")
+
+# pg_try_advisory_xact_lock(namespace, key)의 namespace 값
+LOCK_NS_USER = 1
+LOCK_NS_DIARY = 2
+
+
+class LeaseLost(Exception):
+    """다른 워커가 리스 만료된 작업을 회수해 간 경우 발생합니다."""
+
+
+def make_dedupe_key(job_type, *parts):
+    """같은 생성 요청인지 판별하기 위한 해시를 만듭니다."""
+    raw = json.dumps([job_type, *parts], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def find_active_job(db: Session, dedupe_key):
+    """같은 요청으로 대기/진행 중인 작업이 있으면 반환합니다."""
+    return db.query(models.GenerationJob).\
+        filter(models.GenerationJob.dedupe_key == dedupe_key,
+               models.GenerationJob.status.in_(ACTIVE_STATUSES)).\
+        first()
+
+
+def enqueue_job(db: Session, job_type, user_id, diary_id, cut_id=None, payload=None, dedupe_key=None,
+                priority=None, cuts_count=None):
+    """
+    작업을 큐에 등록합니다. 커밋은 호출한 쪽에서 합니다.
+    dedupe_key가 같은 작업이 이미 진행 중이면 커밋 시 IntegrityError가 발생하므로
+    호출한 쪽에서 롤백 후 find_active_job으로 기존 작업에 합류합니다.
+    """
+    if priority is None:
+        priority = JOB_PRIORITIES.get(job_type, 1)
+
+    job = models.GenerationJob(
+        job_type=job_type,
+        user_id=user_id,
+        diary_id=diary_id,
+        cut_id=cut_id,
+        payload=payload or {},
+        dedupe_key=dedupe_key,
+        priority=priority,
+        fair_tag=fair_tag(db, user_id, job_cost(job_type, payload, cuts_count)),
+        status="queued"
+    )
+    db.add(job)
+    return job
+
+
+def _try_xact_lock(db: Session, namespace, key):
+    """트랜잭션이 끝날 때까지 유지되는 advisory lock을 시도합니다."""
+    return db.execute(text("SELECT pg_try_advisory_xact_lock(:ns, :key)"),
+                      {"ns": namespace, "key": key}).scalar()
+
+
+def _live_running_jobs(db: Session):
+    """리스가 살아 있는 실행 중 작업"""
+    return db.query(models.GenerationJob).\
+        filter(models.GenerationJob.status == "running",
+               models.GenerationJob.locked_until >= func.now())
+
+
+def _diary_is_busy(db: Session, diary_id):
+    return _live_running_jobs(db).\
+        filter(models.GenerationJob.diary_id == diary_id).\
+        first() is not None
+
+
+def _user_is_busy(db: Session, user_id):
+    running = _live_running_jobs(db).\
+        filter(models.GenerationJob.user_id == user_id).\
+        with_entities(func.count(models.GenerationJob.job_id)).\
+        scalar()
+    return running >= USER_MAX_RUNNING_JOBS
+
+
+def _can_claim(db: Session, job):
+    """
+    같은 일기를 두 작업이 동시에 처리하거나, 한 사용자가 동시 실행 한도를 넘지 않도록
+    일기/사용자 단위로 잠근 뒤 다시 확인합니다.
+    (다른 워커가 커밋하기 전의 점유는 조회로 보이지 않으므로 잠금으로 직렬화)
+    """
+    if job.diary_id is not None:
+        if not _try_xact_lock(db, LOCK_NS_DIARY, job.diary_id) or _diary_is_busy(db, job.diary_id):
+            return False
+    if job.user_id is not None:
+        if not _try_xact_lock(db, LOCK_NS_USER, job.user_id) or _user_is_busy(db, job.user_id):
+            return False
+    return True
+
+
+def claim_next_job(db: Session, worker_id):
+    """
+    대기 중이거나 리스가 만료된 작업 하나를 가져옵니다.
+    FOR UPDATE SKIP LOCKED로 여러 워커가 같은 작업을 동시에 가져가지 않도록 합니다.
+    우선순위 -> 공정 태그 순으로 가져오며, 동시 실행 한도에 도달한 사용자의 작업과
+    다른 작업이 처리 중인 일기의 작업은 건너뜁니다.
+    """
+    busy_diaries = _live_running_jobs(db).\
+        filter(models.GenerationJob.diary_id.isnot(None)).\
+        with_entities(models.GenerationJob.diary_id)
+
+    while True:
+        candidates = db.query(models.GenerationJob).\
+            filter(or_(
+                models.GenerationJob.status == "queued",
+                and_(models.GenerationJob.status == "running",
+                     models.GenerationJob.locked_until < func.now())
+            )).\
+            filter(or_(models.GenerationJob.user_id.is_(None),
+                       ~models.GenerationJob.user_id.in_(busy_users_query(db)))).\
+            filter(or_(models.GenerationJob.diary_id.is_(None),
+                       ~models.GenerationJob.diary_id.in_(busy_diaries))).\
+            order_by(models.GenerationJob.priority,
+                     models.GenerationJob.fair_tag.nulls_first(),
+                     models.GenerationJob.created_at).\
+            limit(CLAIM_BATCH_SIZE).\
+            with_for_update(skip_locked=True).\
+            all()
+
+        if not candidates:
+            db.rollback()
+            return None
+
+        # 리스 만료로 계속 회수되는 작업은 실패 처리 (워커를 죽이는 작업 반복 방지)
+        exhausted = next((c for c in candidates if c.attempts >= JOB_MAX_ATTEMPTS), None)
+        if exhausted is not None:
+            fail_job(db, exhausted, "최대 재시도 횟수 초과 (워커 중단 반복)")
+            continue
+
+        job = next((c for c in candidates if _can_claim(db, c)), None)
+        if job is None:
+            db.rollback()
+            return None
+
+        job.status = "running"
+        job.attempts += 1
+        job.worker_id = worker_id
+        job.locked_until = func.now() + timedelta(seconds=JOB_LEASE_SECONDS)
+        if job.started_at is None:
+            job.started_at = func.now()
+        db.commit()
+        db.refresh(job)
+        return job
+
+
+def heartbeat(db: Session, job, worker_id):
+    """리스를 연장합니다. 이미 다른 워커가 가져갔다면 LeaseLost를 발생시킵니다."""
+    updated = db.query(models.GenerationJob).\
+        filter(models.GenerationJob.job_id == job.job_id,
+               models.GenerationJob.worker_id == worker_id,
+               models.GenerationJob.status == "running").\
+        update({models.GenerationJob.locked_until: func.now() + timedelta(seconds=JOB_LEASE_SECONDS)},
+               synchronize_session=False)
+    db.commit()
+    if not updated:
+        raise LeaseLost(f"job {job.job_id} 리스 상실")
+
+
+def complete_job(db: Session, job, result=None):
+    job.status = "succeeded"
+    job.result = result
+    job.locked_until = None
+    job.finished_at = func.now()
+    db.commit()
+
+
+def fail_job(db: Session, job, error):
+    """작업을 실패 처리하고, 이 작업이 맡고 있던 pending 컷도 failed로 정리합니다."""
+    job.status = "failed"
+    job.error = str(error)
+    job.locked_until = None
+    job.finished_at = func.now()
+
+    pending_cuts = db.query(models.Cut).filter(models.Cut.status == "pending")
+    if job.cut_id:
+        pending_cuts = pending_cuts.filter(models.Cut.cut_id == job.cut_id)
+    else:
+        story_ids = db.query(models.Story.story_id).filter(models.Story.diary_id == job.diary_id)
+        pending_cuts = pending_cuts.filter(models.Cut.story_id.in_(story_ids))
+    for cut in pending_cuts.all():
+        cut.status = "failed"
+        if not cut.image_url:
+            cut.image_url = "https://via.placeholder.com/1024?text=Generation+Failed"
+
+    db.commit()
+
+
+def recover_stuck_cuts(db: Session):
+    """
+    담당 작업 없이 오래 pending 상태로 남은 컷(예: 큐 도입 전 요청 중단)을
+    컷 재생성 작업으로 다시 큐에 넣습니다. 등록한 작업 수를 반환합니다.
+    """
+    active_diaries = db.query(models.GenerationJob.diary_id).\
+        filter(models.GenerationJob.status.in_(ACTIVE_STATUSES))
+
+    stuck = db.query(models.Cut, models.Diary).\
+        join(models.Story, models.Story.story_id == models.Cut.story_id).\
+        join(models.Diary, models.Diary.diary_id == models.Story.diary_id).\
+        filter(models.Cut.status == "pending",
+               models.Cut.created_at < func.now() - timedelta(seconds=STUCK_CUT_SECONDS),
+               ~models.Diary.diary_id.in_(active_diaries)).\
+        all()
+
+    # 모든 워커가 주기적으로 실행하므로 같은 컷을 두 번 등록하지 않도록 dedupe_key로 막음
+    recovered = 0
+    for cut, diary in stuck:
+        try:
+            with db.begin_nested():
+                enqueue_job(db, "regenerate_cut", diary.user_id, diary.diary_id, cut_id=cut.cut_id,
+                            dedupe_key=make_dedupe_key("recover_cut", cut.cut_id), priority=RECOVERY_PRIORITY)
+            recovered += 1
+        except IntegrityError:
+            # 다른 워커가 먼저 등록함
+            pass
+    db.commit()
+    return recovered
+
+
+def job_progress(db: Session, job):
+    """작업이 담당하는 컷들의 상태별 개수를 반환합니다."""
+    query = db.query(models.Cut.status, func.count(models.Cut.cut_id))
+    if job.cut_id:
+        query = query.filter(models.Cut.cut_id == job.cut_id)
+    else:
+        story_ids = db.query(models.Story.story_id).filter(models.Story.diary_id == job.diary_id)
+        query = query.filter(models.Cut.story_id.in_(story_ids))
+    counts = dict(query.group_by(models.Cut.status).all())
+    return {
+        "total": sum(counts.values()),
+        "completed": counts.get("completed", 0),
+        "failed": counts.get("failed", 0),
+        "pending": counts.get("pending", 0)
+    }
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean, JSON, Float, LargeBinary, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -63,4 +63,66 @@ class Cut(Base):
     status = Column(String, default="pending")   # 생성 상태
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    story = relationship("Story", back_populates="cuts")
\ No newline at end of file
+    story = relationship("Story", back_populates="cuts")
+
+
+# 5. 생성 작업 큐 테이블 (worker.py가 SKIP LOCKED로 가져가서 처리)
+class GenerationJob(Base):
+    __tablename__ = "generation_jobs"
+
+    job_id = Column(Integer, primary_key=True, index=True)
+    job_type = Column(String, nullable=False)                 # create_diary / regenerate_diary / regenerate_cut
+    user_id = Column(Integer, ForeignKey("users.user_id"), index=True)
+    diary_id = Column(Integer, ForeignKey("diaries.diary_id", ondelete="CASCADE"), index=True)
+    cut_id = Column(Integer, ForeignKey("cuts.cut_id", ondelete="CASCADE"), nullable=True)
+    payload = Column(JSON, default=dict)                      # 작업에 필요한 설정값 (장르, 스타일 등)
+    dedupe_key = Column(String, nullable=True)                # 같은 요청 판별용 해시 (진행 중인 작업에 합류)
+    status = Column(String, default="queued", index=True)     # queued / running / succeeded / failed
+    priority = Column(Integer, default=1)                     # 0: 첫 생성, 1: 재생성, 2: 백그라운드 회수
+    fair_tag = Column(Float, nullable=True)                   # 사용자별 공정 큐잉 순서 (가상 종료 시각)
+    attempts = Column(Integer, default=0)
+    worker_id = Column(String, nullable=True)
+    locked_until = Column(DateTime(timezone=True), nullable=True)  # 리스 만료 시각 (지나면 다른 워커가 회수)
+    error = Column(Text, nullable=True)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # 같은 요청은 동시에 하나의 작업만 진행 (queued/running 상태에서만 유일)
+        Index("ix_generation_jobs_active_dedupe", "dedupe_key", unique=True,
+              postgresql_where=status.in_(["queued", "running"])),
+        # 워커가 작업을 가져가는 순서 (우선순위 -> 공정 태그)
+        Index("ix_generation_jobs_claim_order", "status", "priority", "fair_tag"),
+    )
+
+
+# 6. Idempotency-Key 저장 테이블 (재시도 요청에 저장된 응답을 그대로 반환)
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_records"
+
+    record_id = Column(Integer, primary_key=True, index=True)
+    scope = Column(String, nullable=False)                    # 예: "POST /api/diaries"
+    idempotency_key = Column(String, nullable=False)
+    request_hash = Column(String, nullable=False)             # 같은 키로 다른 내용을 보내는 경우 차단
+    status = Column(String, default="in_progress")            # in_progress / completed
+    response_body = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)  # 만료 기록 정리용
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("scope", "idempotency_key", name="uq_idempotency_scope_key"),
+    )
+
+
+# 7. 컷 이미지 프롬프트 임베딩 (워커들이 공유하는 유사 프롬프트 이미지 재사용 인덱스의 원본)
+class PromptEmbedding(Base):
+    __tablename__ = "prompt_embeddings"
+
+    cut_id = Column(Integer, ForeignKey("cuts.cut_id", ondelete="CASCADE"), primary_key=True)  # 컷/일기 삭제 시 함께 삭제
+    style = Column(String, nullable=False)
+    image_url = Column(Text, nullable=False, index=True)
+    embedding = Column(LargeBinary, nullable=False)          # 정규화된 float32 벡터 바이트
+    rejected = Column(Boolean, default=False)                # 재생성으로 거절된 이미지 (재사용 대상에서 제외, 백필 대상에서도 제외)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
@@ -0,0 +1,110 @@
+import json
+import os
+import time
+from datetime import timedelta
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+import models
+
+# 사용자별 공정 스케줄링 설정
+USER_MAX_RUNNING_JOBS = int(os.getenv("USER_MAX_RUNNING_JOBS", "2"))      # 사용자 1명이 동시에 점유할 수 있는 워커 작업 수
+USER_JOBS_PER_MINUTE = int(os.getenv("USER_JOBS_PER_MINUTE", "10"))       # 사용자 1명이 1분에 등록할 수 있는 생성 작업 수
+JOB_COST_UNIT_SECONDS = float(os.getenv("JOB_COST_UNIT_SECONDS", "15"))   # 이미지 1장(또는 Gemini 호출 1회) 처리 비용 추정치
+USER_WEIGHTS = {int(k): float(v) for k, v in json.loads(os.getenv("SCHEDULER_USER_WEIGHTS", "{}")).items()}  # 예: {"12": 2}
+
+# 우선순위 (숫자가 작을수록 먼저 처리). 첫 생성은 사용자가 기다리고 있으므로 재생성보다 우선
+JOB_PRIORITIES = {
+    "create_diary": 0,
+    "regenerate_diary": 1,
+    "regenerate_cut": 1,
+}
+RECOVERY_PRIORITY = 2  # 방치된 컷 회수 등 백그라운드 작업
+
+# pg_advisory_xact_lock(namespace, key)의 namespace 값 (jobs.py의 LOCK_NS_*와 겹치지 않게)
+LOCK_NS_RATE_LIMIT = 3
+
+
+def job_cost(job_type, payload, cuts_count=None):
+    """작업 비용 추정 (Gemini 1회 + 이미지 장수)"""
+    if job_type == "regenerate_cut":
+        return 1
+    cuts = cuts_count or (payload or {}).get("cuts_count") or 4
+    return cuts + 1
+
+
+def fair_tag(db: Session, user_id, cost):
+    """
+    가중 공정 큐잉(WFQ)의 가상 종료 시각을 계산합니다.
+    사용자의 대기/진행 중 작업이 많을수록 새 작업의 태그가 뒤로 밀려,
+    작업을 몰아서 넣은 사용자가 다른 사용자의 차례를 빼앗지 못합니다.
+    """
+    last_tag = db.query(func.max(models.GenerationJob.fair_tag)).\
+        filter(models.GenerationJob.user_id == user_id,
+               models.GenerationJob.status.in_(("queued", "running"))).\
+        scalar()
+    start = max(time.time(), last_tag or 0)
+    weight = USER_WEIGHTS.get(user_id, 1.0)
+    return start + cost * JOB_COST_UNIT_SECONDS / weight
+
+
+def busy_users_query(db: Session):
+    """동시 실행 한도에 도달한 사용자 ID 서브쿼리"""
+    return db.query(models.GenerationJob.user_id).\
+        filter(models.GenerationJob.status == "running",
+               models.GenerationJob.locked_until >= func.now(),
+               models.GenerationJob.user_id.isnot(None)).\
+        group_by(models.GenerationJob.user_id).\
+        having(func.count(models.GenerationJob.job_id) >= USER_MAX_RUNNING_JOBS)
+
+
+def check_rate_limit(db: Session, user_id):
+    """
+    사용자별 작업 등록 속도 제한. 초과하면 429를 반환합니다.
+    같은 사용자의 동시 요청이 모두 한도 전 개수를 보고 등록하지 않도록, 작업을 등록하는
+    트랜잭션이 커밋될 때까지 사용자 단위 잠금을 유지합니다. (호출 후 같은 트랜잭션에서 등록/커밋)
+    """
+    db.execute(text("SELECT pg_advisory_xact_lock(:ns, :key)"), {"ns": LOCK_NS_RATE_LIMIT, "key": user_id})
+    recent = db.query(func.count(models.GenerationJob.job_id)).\
+        filter(models.GenerationJob.user_id == user_id,
+               models.GenerationJob.created_at >= func.now() - timedelta(minutes=1)).\
+        scalar()
+    if recent >= USER_JOBS_PER_MINUTE:
+        raise HTTPException(status_code=429, detail="생성 요청이 너무 많습니다. 잠시 후 다시 시도해주세요.")
+
+
+def queue_metrics(db: Session, top_n=10):
+    """큐 깊이 지표 (상태/유형/우선순위별 개수, 가장 오래 기다린 작업, 대기열이 긴 사용자)"""
+    active = db.query(models.GenerationJob).filter(models.GenerationJob.status.in_(("queued", "running")))
+
+    by_status = dict(active.with_entities(models.GenerationJob.status, func.count()).
+                     group_by(models.GenerationJob.status).all())
+    queued = active.filter(models.GenerationJob.status == "queued")
+    by_type = dict(queued.with_entities(models.GenerationJob.job_type, func.count()).
+                   group_by(models.GenerationJob.job_type).all())
+    by_priority = dict(queued.with_entities(models.GenerationJob.priority, func.count()).
+                       group_by(models.GenerationJob.priority).all())
+    oldest_wait = queued.with_entities(
+        func.extract("epoch", func.now() - func.min(models.GenerationJob.created_at))
+    ).scalar()
+
+    queued_count = func.count().filter(models.GenerationJob.status == "queued")
+    running_count = func.count().filter(models.GenerationJob.status == "running")
+    top_users = active.with_entities(models.GenerationJob.user_id, queued_count, running_count).\
+        group_by(models.GenerationJob.user_id).\
+        order_by(queued_count.desc()).\
+        limit(top_n).all()
+
+    return {
+        "queued": by_status.get("queued", 0),
+        "running": by_status.get("running", 0),
+        "queued_by_type": by_type,
+        "queued_by_priority": by_priority,
+        "oldest_queued_seconds": float(oldest_wait) if oldest_wait is not None else 0.0,
+        "users_waiting": queued.with_entities(func.count(func.distinct(models.GenerationJob.user_id))).scalar(),
+        "top_users": [
+            {"user_id": user_id, "queued": q, "running": r} for user_id, q, r in top_users
+        ]
+    }
@@ -0,0 +1,291 @@
+"""
+생성 작업 워커 (API 서버와 별도로 실행)
+
+    python worker.py
+
+generation_jobs 테이블에서 작업을 SKIP LOCKED로 하나씩 가져와 Gemini/Imagen 생성을 수행합니다.
+워커가 중간에 죽어도 리스(locked_until)가 만료되면 다른 워커가 이어서 처리합니다.
+"""
+import os
+import signal
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import models
+from database import SessionLocal, engine
+from generation import (
+    generate_story, generate_image, generate_or_reuse_image, embed_prompt, build_image_prompt, make_filename,
+    PLACEHOLDER_URL, REGEN_PLACEHOLDER_URL, DIARY_BUDGET_SECONDS
+)
+from idempotency import purge_expired_records
+from image_index import (
+    prompt_image_index, save_prompt_embedding, reject_images, cuts_missing_embeddings, try_lock_backfill,
+    IMAGE_INDEX_BACKFILL_BATCH
+)
+from jobs import (
+    claim_next_job, heartbeat, complete_job, fail_job, recover_stuck_cuts, LeaseLost
+)
+
+POLL_INTERVAL_SECONDS = float(os.getenv("WORKER_POLL_INTERVAL", "2"))
+RECOVERY_INTERVAL_SECONDS = int(os.getenv("WORKER_RECOVERY_INTERVAL", "60"))
+
+# SIGTERM(Cloud Run 인스턴스 종료 등)을 받으면 현재 작업까지만 처리하고 종료
+stop_requested = False
+
+def _request_stop(signum, frame):
+    global stop_requested
+    print(f"종료 신호 수신 ({signum}), 현재 작업 후 종료합니다.")
+    stop_requested = True
+
+
+def _render_pending_cuts(db, job, worker_id, story, deadline, filename_suffix="", reuse_images=True):
+    """
+    pending 상태인 컷의 이미지를 동시에 생성합니다. 컷마다 커밋하므로 중단되어도 이어서 처리됩니다.
+    마감(deadline)을 넘긴 컷은 임시 이미지와 failed 상태로 저장되어 나중에 재생성할 수 있습니다.
+    reuse_images=False이면 유사 프롬프트 이미지를 재사용하지 않고 항상 새로 생성합니다 (재생성 요청).
+    """
+    pending_cuts = db.query(models.Cut).\
+        filter(models.Cut.story_id == story.story_id, models.Cut.status == "pending").\
+        order_by(models.Cut.cut_number).all()
+    if not pending_cuts:
+        return
+
+    heartbeat(db, job, worker_id)
+    with ThreadPoolExecutor(max_workers=len(pending_cuts)) as pool:
+        futures = {}
+        for cut in pending_cuts:
+            print(f"   - {cut.cut_number}번 컷 생성 중 (Imagen)...")
+            filename = make_filename(story.story_id, cut.cut_number, filename_suffix)
+            if reuse_images:
+                future = pool.submit(generate_or_reuse_image, cut.image_prompt, story.style, filename, deadline)
+            else:
+                future = pool.submit(lambda *args: (generate_image(*args), None), cut.image_prompt, filename, deadline)
+            futures[future] = cut
+
+        # DB 세션은 스레드 간 공유하지 않으므로 결과 저장은 이 스레드에서만 함
+        for future in as_completed(futures):
+            cut = futures[future]
+            try:
+                cut.image_url, embedding = future.result()
+                cut.status = "completed"
+                if embedding is not None:
+                    save_prompt_embedding(db, cut.cut_id, story.style, cut.image_url, embedding)
+                print(f"   -> GCS 업로드 완료: {cut.image_url}")
+            except Exception as e:
+                print(f"   - Imagen 실패 ({cut.cut_number}컷): {e}")
+                cut.image_url = PLACEHOLDER_URL
+                cut.status = "failed"
+            db.commit()
+            heartbeat(db, job, worker_id)
+
+
+def _save_story_and_cuts(db, job, story, llm_result, use_dialogue_as_action):
+    """Gemini 결과로 스토리를 갱신하고 컷을 pending 상태로 만들어 둡니다."""
+    story.full_story = llm_result.get("full_story", "")
+
+    for i, cut in enumerate(llm_result.get("cuts", [])):
+        action = cut.get("dialogue", "") if use_dialogue_as_action else cut.get("scene_description", "")
+        db.add(models.Cut(
+            story_id=story.story_id,
+            cut_number=i + 1,
+            cut_content=cut.get("dialogue", ""),
+            image_prompt=build_image_prompt(story.style, story.character_note, action, cut.get("image_prompt", "")),
+            status="pending"
+        ))
+
+    # 스토리 단계 완료 기록 (재시도 시 Gemini를 다시 호출하지 않음)
+    job.result = {"stage": "rendering"}
+    db.commit()
+
+
+def run_create_diary(db, job, worker_id):
+    diary = db.query(models.Diary).filter(models.Diary.diary_id == job.diary_id).first()
+    if not diary:
+        raise ValueError("일기를 찾을 수 없습니다.")
+
+    settings = job.payload
+    deadline = time.monotonic() + DIARY_BUDGET_SECONDS
+    story = db.query(models.Story).filter(models.Story.diary_id == diary.diary_id).first()
+
+    if (job.result or {}).get("stage") != "rendering":
+        llm_result = generate_story(
+            diary.original_content, settings["genre"], settings["style"],
+            settings["character_note"], settings["cuts_count"], deadline
+        )
+        print("3. Gemini 각색 완료")
+
+        if story is None:
+            story = models.Story(
+                diary_id=diary.diary_id,
+                genre=settings["genre"],
+                style=settings["style"],
+                character_note=settings["character_note"],
+                total_cuts=settings["cuts_count"]
+            )
+            db.add(story)
+            db.flush()
+        else:
+            # 이전 시도에서 스토리만 저장되고 중단된 경우
+            db.query(models.Cut).filter(models.Cut.story_id == story.story_id).delete()
+        _save_story_and_cuts(db, job, story, llm_result, use_dialogue_as_action=False)
+        heartbeat(db, job, worker_id)
+
+    _render_pending_cuts(db, job, worker_id, story, deadline)
+    return {"stage": "done", "diary_id": diary.diary_id}
+
+
+def run_regenerate_diary(db, job, worker_id):
+    diary = db.query(models.Diary).filter(models.Diary.diary_id == job.diary_id).first()
+    story = db.query(models.Story).filter(models.Story.diary_id == job.diary_id).first()
+    if not diary or not story:
+        raise ValueError("일기를 찾을 수 없습니다.")
+
+    deadline = time.monotonic() + DIARY_BUDGET_SECONDS
+    if (job.result or {}).get("stage") != "rendering":
+        llm_result = generate_story(
+            diary.original_content, story.genre, story.style,
+            story.character_note, story.total_cuts, deadline
+        )
+        print("3. Gemini 각색 완료")
+
+        # 기존 컷 삭제 후 새 컷을 pending으로 저장 (기존 이미지는 거절된 것으로 보고 재사용 대상에서 제외)
+        old_urls = [url for (url,) in db.query(models.Cut.image_url).
+                    filter(models.Cut.story_id == story.story_id, models.Cut.status == "completed")]
+        reject_images(db, old_urls)
+        db.query(models.Cut).filter(models.Cut.story_id == story.story_id).delete()
+        _save_story_and_cuts(db, job, story, llm_result, use_dialogue_as_action=True)
+        heartbeat(db, job, worker_id)
+        print("4. 기존 컷 정보 삭제 및 스토리 업데이트 완료")
+
+    # 사용자가 교체를 요청한 재생성이므로 기존 이미지를 재사용하지 않음
+    _render_pending_cuts(db, job, worker_id, story, deadline, filename_suffix="_regen", reuse_images=False)
+    return {"stage": "done", "diary_id": diary.diary_id}
+
+
+def run_regenerate_cut(db, job, worker_id):
+    cut = db.query(models.Cut).filter(models.Cut.cut_id == job.cut_id).first()
+    if not cut:
+        raise ValueError("컷을 찾을 수 없습니다.")
+
+    target_prompt = job.payload.get("prompt_override") or cut.image_prompt
+    # 사용자가 교체를 요청한 이미지는 다른 사용자에게도 재사용하지 않음
+    if job.payload.get("rejected_url"):
+        reject_images(db, [job.payload["rejected_url"]])
+    try:
+        print(f"   - {cut.cut_number}번 컷 이미지 재생성 중...")
+        cut.image_url = generate_image(target_prompt, make_filename(cut.story_id, cut.cut_number, "_regen"))
+        cut.status = "completed"
+        print(f"   -> GCS 업로드 완료: {cut.image_url}")
+    except Exception as e:
+        print(f"   - 재생성 실패: {e}")
+        cut.image_url = REGEN_PLACEHOLDER_URL
+        cut.status = "failed"
+
+    cut.image_prompt = target_prompt
+    if cut.status == "completed" and prompt_image_index is not None:
+        _replace_cut_embedding(db, cut)
+    db.commit()
+    return {"new_image_url": cut.image_url}
+
+
+def _replace_cut_embedding(db, cut):
+    """재생성된 컷의 새 이미지를 인덱스에 다시 등록합니다 (기존 행은 거절 표시된 이전 이미지를 가리킴)."""
+    story = db.query(models.Story).filter(models.Story.story_id == cut.story_id).first()
+    try:
+        save_prompt_embedding(db, cut.cut_id, story.style, cut.image_url, embed_prompt(cut.image_prompt), replace=True)
+    except Exception as e:
+        # 이전 이미지를 가리키는 행을 지워 두면 백필이 새 이미지로 다시 등록함
+        print(f"   - 프롬프트 임베딩 실패, 백필로 미룹니다 (cut {cut.cut_id}): {e}")
+        db.query(models.PromptEmbedding).\
+            filter(models.PromptEmbedding.cut_id == cut.cut_id).\
+            delete(synchronize_session=False)
+
+
+JOB_HANDLERS = {
+    "create_diary": run_create_diary,
+    "regenerate_diary": run_regenerate_diary,
+    "regenerate_cut": run_regenerate_cut,
+}
+
+
+def run_job(db, job, worker_id):
+    print(f"[job {job.job_id}] {job.job_type} 시작 (시도 {job.attempts})")
+    try:
+        result = JOB_HANDLERS[job.job_type](db, job, worker_id)
+    except LeaseLost as e:
+        # 다른 워커가 이미 이어받았으므로 아무것도 기록하지 않음
+        db.rollback()
+        print(f"[job {job.job_id}] {e}")
+        return
+    except Exception as e:
+        db.rollback()
+        print(f"[job {job.job_id}] 실패: {e}")
+        fail_job(db, job, e)
+        return
+
+    complete_job(db, job, result)
+    print(f"[job {job.job_id}] 완료")
+    if prompt_image_index is not None:
+        print(f"이미지 인덱스 통계: {prompt_image_index.stats()}")
+
+
+def sync_image_index(db):
+    """다른 워커가 저장한 임베딩을 불러오고, 삭제/거절된 항목을 지운 뒤 기존 완료 컷을 조금씩 백필합니다."""
+    prompt_image_index.sync(db)
+
+    # 백필은 한 번에 워커 하나만 (다른 워커는 이번 주기를 건너뜀)
+    if try_lock_backfill(db):
+        for cut, style in cuts_missing_embeddings(db, IMAGE_INDEX_BACKFILL_BATCH):
+            try:
+                save_prompt_embedding(db, cut.cut_id, style, cut.image_url, embed_prompt(cut.image_prompt))
+            except Exception as e:
+                print(f"임베딩 백필 실패 (cut {cut.cut_id}): {e}")
+                break
+    db.commit()
+    print(f"이미지 인덱스 통계: {prompt_image_index.stats()}")
+
+
+def main():
+    models.Base.metadata.create_all(bind=engine)
+
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    print(f"워커 시작: {worker_id}")
+
+    last_recovery = 0.0
+    while not stop_requested:
+        db = SessionLocal()
+        try:
+            if time.monotonic() - last_recovery > RECOVERY_INTERVAL_SECONDS:
+                # 실패해도 다음 주기까지 기다림 (매 폴링마다 다시 돌면서 작업 처리를 막지 않도록)
+                last_recovery = time.monotonic()
+                recovered = recover_stuck_cuts(db)
+                if recovered:
+                    print(f"방치된 pending 컷 {recovered}개 재등록")
+                purged = purge_expired_records(db)
+                if purged:
+                    print(f"만료된 Idempotency 기록 {purged}개 삭제")
+                if prompt_image_index is not None:
+                    sync_image_index(db)
+
+            job = claim_next_job(db, worker_id)
+            if job is None:
+                time.sleep(POLL_INTERVAL_SECONDS)
+                continue
+
+            run_job(db, job, worker_id)
+        except Exception as e:
+            db.rollback()
+            print(f"워커 루프 에러: {e}")
+            time.sleep(POLL_INTERVAL_SECONDS)
+        finally:
+            db.close()
+
+    print("워커 종료")
+
+
+if __name__ == "__main__":
+    main()